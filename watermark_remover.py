@@ -1,74 +1,156 @@
 import cv2
 import numpy as np
 import glob
-from moviepy.video.io import VideoFileClip
+from collections import OrderedDict
+from functools import lru_cache
+from moviepy.video.io.VideoFileClip import VideoFileClip
 import os
 import sys
 import argparse
 from tqdm import tqdm
+from numba import njit, prange
+import xxhash
 from lama_cleaner.model_manager import ModelManager
 from lama_cleaner.schema import Config, HDStrategy
 import time
+import subprocess
+import threading
+import queue
 from datetime import timedelta
-import imagehash
-from PIL import Image
+import torch
+from imageio_ffmpeg import get_ffmpeg_exe
 import numpy as np
 
+def hamming_distance(hash1, hash2):
+    return (hash1 ^ hash2).bit_count()
+
+
+class BKTreeNode:
+    def __init__(self, hash_value, value, entry_id):
+        self.hash = hash_value
+        self.value = value
+        self.entry_id = entry_id
+        self.alive = True
+        self.children = {}
+
+
 class FrameCache:
     def __init__(self, cache_size=100, similarity_threshold=5):
-        self.cache = {}
+        self.root = None
+        self.entries = OrderedDict()
         self.cache_size = cache_size
         self.similarity_threshold = similarity_threshold
-        self.access_count = {}
+        self.tombstones = 0
+        self.next_entry_id = 0
     
     def compute_hash(self, roi):
-        small_roi = cv2.resize(roi, (64, 64))
-        pil_image = Image.fromarray(cv2.cvtColor(small_roi, cv2.COLOR_BGR2RGB))
-        return imagehash.phash(pil_image)
+        gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
+        small_gray = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+        low_freq = cv2.dct(small_gray)[:8, :8].ravel()
+        bits = low_freq > np.median(low_freq[1:])
+        return int.from_bytes(np.packbits(bits).tobytes(), "big")
     
-    def get(self, roi):
-        frame_hash = self.compute_hash(roi)
-        
+    def find_nearest(self, frame_hash):
         best_match = None
-        min_distance = float('inf')
+        min_distance = self.similarity_threshold + 1
+        stack = [self.root] if self.root is not None else []
         
-        for cached_hash in self.cache:
-            distance = frame_hash - cached_hash
-            if distance < min_distance:
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(frame_hash, node.hash)
+            if node.alive and distance < min_distance:
                 min_distance = distance
-                best_match = cached_hash
-        
-        if best_match is not None and min_distance <= self.similarity_threshold:
-            self.access_count[best_match] += 1
-            return self.cache[best_match]
+                best_match = node
+            
+            for edge in range(max(0, distance - self.similarity_threshold), distance + self.similarity_threshold + 1):
+                child = node.children.get(edge)
+                if child is not None:
+                    stack.append(child)
         
-        return None
+        return best_match
     
-    def put(self, roi, processed_result):
+    def probe(self, roi):
         frame_hash = self.compute_hash(roi)
+        node = self.find_nearest(frame_hash)
+        
+        if node is not None:
+            self.entries.move_to_end(node.entry_id)
+            return node.value, frame_hash
         
-        if len(self.cache) >= self.cache_size:
-            least_used = min(self.access_count, key=self.access_count.get)
-            del self.cache[least_used]
-            del self.access_count[least_used]
+        return None, frame_hash
+    
+    def insert(self, frame_hash, processed_result):
+        if len(self.entries) >= self.cache_size:
+            _, evicted = self.entries.popitem(last=False)
+            self.remove_node(evicted)
+        
+        self.insert_node(frame_hash, processed_result)
+        
+        if self.tombstones > (len(self.entries) + self.tombstones) // 4:
+            self.rebuild()
+    
+    def insert_node(self, frame_hash, processed_result):
+        entry_id = self.next_entry_id
+        self.next_entry_id += 1
+        
+        if self.root is None:
+            self.root = BKTreeNode(frame_hash, processed_result, entry_id)
+            self.entries[entry_id] = self.root
+            return
+        
+        node = self.root
+        while True:
+            distance = hamming_distance(frame_hash, node.hash)
+            if distance == 0:
+                if node.alive:
+                    del self.entries[node.entry_id]
+                else:
+                    node.alive = True
+                    self.tombstones -= 1
+                node.value = processed_result
+                node.entry_id = entry_id
+                self.entries[entry_id] = node
+                return
+            
+            child = node.children.get(distance)
+            if child is None:
+                child = BKTreeNode(frame_hash, processed_result, entry_id)
+                node.children[distance] = child
+                self.entries[entry_id] = child
+                return
+            node = child
+    
+    def remove_node(self, node):
+        node.alive = False
+        node.value = None
+        self.tombstones += 1
+    
+    def rebuild(self):
+        live_nodes = list(self.entries.values())
+        self.root = None
+        self.entries = OrderedDict()
+        self.tombstones = 0
         
-        self.cache[frame_hash] = processed_result
-        self.access_count[frame_hash] = 1
+        for node in live_nodes:
+            self.insert_node(node.hash, node.value)
 
 
 class FrameSkipDetector:
-    def __init__(self, keyframe_interval=5, scene_change_threshold=50.0):
+    def __init__(self, keyframe_interval=5, scene_change_threshold=6.0):
         self.keyframe_interval = keyframe_interval
         self.scene_change_threshold = scene_change_threshold
-        self.prev_roi = None
+        self.prev_small = None
+        self.current_small = None
     
     def should_process_frame(self, frame_index, roi):
+        self.current_small = None
         is_keyframe = (frame_index % self.keyframe_interval == 0)
         if is_keyframe:
             return True
         
-        if self.prev_roi is not None:
-            diff = self.calculate_frame_difference(roi, self.prev_roi)
+        if self.prev_small is not None:
+            self.current_small = self.downsample(roi)
+            diff = self.calculate_frame_difference(self.current_small, self.prev_small)
             if diff > self.scene_change_threshold:
                 return True
         
@@ -76,19 +158,20 @@ class FrameSkipDetector:
     
     def update_prev_roi(self, roi):
         if roi is not None:
-            self.prev_roi = roi.copy()
+            self.prev_small = self.current_small if self.current_small is not None else self.downsample(roi)
+            self.current_small = None
+    
+    @staticmethod
+    def downsample(roi):
+        gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(gray, (64, 64), interpolation=cv2.INTER_AREA)
     
     @staticmethod
-    def calculate_frame_difference(roi1, roi2):
-        if roi1 is None or roi2 is None:
+    def calculate_frame_difference(small1, small2):
+        if small1 is None or small2 is None:
             return float('inf')
         
-        gray1 = cv2.cvtColor(roi1, cv2.COLOR_BGR2GRAY)
-        gray2 = cv2.cvtColor(roi2, cv2.COLOR_BGR2GRAY)
-        
-        diff = np.mean((gray1.astype("float") - gray2.astype("float")) ** 2)
-        
-        return diff
+        return cv2.mean(cv2.absdiff(small1, small2))[0]
     
 class WatermarkDetector:
     def __init__(self, num_sample_frames=10, min_frame_count=7, dilation_kernel_size=7):
@@ -96,6 +179,7 @@ class WatermarkDetector:
         self.min_frame_count = min_frame_count
         self.dilation_kernel_size = dilation_kernel_size
         self.roi = None
+        self.roi_coords = None
     
     def get_first_valid_frame(self, video_clip, threshold=10):
         total_frames = int(video_clip.fps * video_clip.duration)
@@ -156,8 +240,8 @@ class WatermarkDetector:
         
         masks = [self.detect_watermark_in_frame(frame) for frame in frames]
         
-        final_mask = sum((mask == 255).astype(np.uint8) for mask in masks)
-        final_mask = np.where(final_mask >= self.min_frame_count, 255, 0).astype(np.uint8)
+        stacked = np.stack(masks) == 255
+        final_mask = (stacked.sum(axis=0, dtype=np.uint8) >= self.min_frame_count).astype(np.uint8) * 255
         
         kernel = np.ones((self.dilation_kernel_size, self.dilation_kernel_size), np.uint8)
         dilated_mask = cv2.dilate(final_mask, kernel, iterations=2)
@@ -165,16 +249,19 @@ class WatermarkDetector:
         return dilated_mask
     
     def get_roi_coordinates(self, watermark_mask, margin=50):
-        y_indices, x_indices = np.where(watermark_mask > 0)
+        mask = watermark_mask > 0
+        y_indices = np.flatnonzero(mask.any(axis=1))
+        x_indices = np.flatnonzero(mask.any(axis=0))
         if len(y_indices) == 0 or len(x_indices) == 0:
             raise ValueError("No watermark region found in mask")
             
-        y_min = max(0, np.min(y_indices) - margin)
-        y_max = min(watermark_mask.shape[0], np.max(y_indices) + margin)
-        x_min = max(0, np.min(x_indices) - margin)
-        x_max = min(watermark_mask.shape[1], np.max(x_indices) + margin)
+        y_min = max(0, int(y_indices[0]) - margin)
+        y_max = min(watermark_mask.shape[0], int(y_indices[-1]) + margin)
+        x_min = max(0, int(x_indices[0]) - margin)
+        x_max = min(watermark_mask.shape[1], int(x_indices[-1]) + margin)
 
-        return (y_min, y_max, x_min, x_max)
+        self.roi_coords = (y_min, y_max, x_min, x_max)
+        return self.roi_coords
     
     def extract_roi_mask(self, watermark_mask, roi_coords):
         y_min, y_max, x_min, x_max = roi_coords
@@ -214,7 +301,8 @@ def get_video_info(video_clip):
     return info
 
 def initialize_lama():
-    model = ModelManager(name="lama", device="cpu")
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = ModelManager(name="lama", device=device)
     config = Config(
         ldm_steps=25,
         hd_strategy=HDStrategy.ORIGINAL,
@@ -225,8 +313,7 @@ def initialize_lama():
 
     return model, config
 
-def lama_inpaint(frame, mask, model, config):
-    mask_binary = np.where(mask > 0, 255, 0).astype(np.uint8)
+def lama_inpaint(frame, mask_binary, model, config):
     result_rgb = model(frame, mask_binary, config)
 
     if result_rgb.dtype == np.float64:
@@ -237,6 +324,162 @@ def lama_inpaint(frame, mask, model, config):
     
     return result_rgb
 
+def prepare_lama_inputs(frames, mask_binary, lama):
+    height, width = mask_binary.shape[:2]
+    pad_height = (lama.pad_mod - height % lama.pad_mod) % lama.pad_mod
+    pad_width = (lama.pad_mod - width % lama.pad_mod) % lama.pad_mod
+
+    images = np.pad(np.stack(frames), ((0, 0), (0, pad_height), (0, pad_width), (0, 0)), mode="symmetric")
+    masks = np.pad(mask_binary, ((0, pad_height), (0, pad_width)), mode="symmetric")
+
+    image_tensor = torch.from_numpy(images).to(lama.device).permute(0, 3, 1, 2).float() / 255
+    mask_tensor = (torch.from_numpy(masks).to(lama.device).float() / 255)[None, None].expand(len(frames), -1, -1, -1)
+
+    return image_tensor, mask_tensor
+
+def optimize_lama(model, frame, mask, tolerance=2.0 / 255):
+    lama = getattr(model, "model", None)
+    module = getattr(lama, "model", None)
+    if getattr(lama, "name", None) != "lama" or module is None:
+        return False
+
+    x, y, w, h = cv2.boundingRect(mask)
+    image_tensor, mask_tensor = prepare_lama_inputs([frame[y:y + h, x:x + w]], mask[y:y + h, x:x + w], lama)
+
+    try:
+        if isinstance(module, torch.jit.ScriptModule):
+            optimized = torch.jit.optimize_for_inference(torch.jit.freeze(module.eval()))
+        else:
+            optimized = torch.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8)
+
+        with torch.no_grad():
+            reference = module(image_tensor, mask_tensor)
+            candidate = optimized(image_tensor, mask_tensor)
+        error = (reference - candidate).abs().mean().item()
+    except Exception as e:
+        print(f"Model optimization failed, keeping FP32 model: {e}")
+        return False
+
+    if error > tolerance:
+        print(f"Optimized model deviates too much ({error:.4f}), keeping FP32 model")
+        return False
+
+    lama.model = optimized
+    return True
+
+def lama_inpaint_batch(frames, mask_binary, model, config):
+    lama = getattr(model, "model", None)
+    if getattr(lama, "name", None) != "lama" or len(frames) <= 1:
+        return [lama_inpaint(frame, mask_binary, model, config)[:, :, ::-1] for frame in frames]
+
+    height, width = mask_binary.shape[:2]
+    image_tensor, mask_tensor = prepare_lama_inputs(frames, mask_binary, lama)
+
+    with torch.no_grad():
+        inpainted = lama.model(image_tensor, mask_tensor)
+
+    inpainted = inpainted[:, :, :height, :width].permute(0, 2, 3, 1).cpu().numpy()
+    inpainted = np.clip(inpainted * 255, 0, 255).astype(np.uint8)
+
+    mask_region = mask_binary[:, :, np.newaxis] > 0
+    return [np.where(mask_region, result, frame) for result, frame in zip(inpainted, frames)]
+
+class CudaGraphInpainter:
+    def __init__(self, model, mask_binary, batch_size=8):
+        self.lama = model.model
+        self.batch_size = batch_size
+        self.height, self.width = mask_binary.shape[:2]
+        self.pad_height = (self.lama.pad_mod - self.height % self.lama.pad_mod) % self.lama.pad_mod
+        self.pad_width = (self.lama.pad_mod - self.width % self.lama.pad_mod) % self.lama.pad_mod
+        self.mask_region = (mask_binary > 0)[:, :, np.newaxis]
+
+        padded_shape = (batch_size, self.height + self.pad_height, self.width + self.pad_width, 3)
+        self.host_images = torch.empty(padded_shape, dtype=torch.uint8).pin_memory()
+        self.host_results = torch.empty(padded_shape, dtype=torch.uint8).pin_memory()
+        self.device_images = torch.empty(padded_shape, dtype=torch.uint8, device="cuda")
+
+        _, mask_tensor = prepare_lama_inputs([np.zeros((self.height, self.width, 3), np.uint8)] * batch_size, mask_binary, self.lama)
+        self.device_masks = mask_tensor.contiguous()
+
+        self.graph = None
+        self.device_results = None
+
+    def forward(self):
+        image_tensor = self.device_images.permute(0, 3, 1, 2).float() / 255
+        inpainted = self.lama.model(image_tensor, self.device_masks)
+        return (inpainted * 255).clamp(0, 255).to(torch.uint8).permute(0, 2, 3, 1).contiguous()
+
+    def capture(self):
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.no_grad(), torch.cuda.stream(stream):
+            for _ in range(3):
+                self.forward()
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.no_grad(), torch.cuda.graph(self.graph):
+            self.device_results = self.forward()
+
+    def __call__(self, frames):
+        results = []
+        for start in range(0, len(frames), self.batch_size):
+            results.extend(self.run(frames[start:start + self.batch_size]))
+        return results
+
+    def run(self, frames):
+        images = np.stack(frames + [frames[-1]] * (self.batch_size - len(frames)))
+        images = np.pad(images, ((0, 0), (0, self.pad_height), (0, self.pad_width), (0, 0)), mode="symmetric")
+        self.host_images.numpy()[...] = images
+        self.device_images.copy_(self.host_images, non_blocking=True)
+
+        if self.graph is None:
+            self.capture()
+        self.graph.replay()
+
+        self.host_results.copy_(self.device_results, non_blocking=True)
+        torch.cuda.current_stream().synchronize()
+
+        inpainted = self.host_results.numpy()[:len(frames), :self.height, :self.width]
+        return [np.where(self.mask_region, result, frame) for result, frame in zip(inpainted, frames)]
+
+def iter_video_frames(input_file, size):
+    width, height = size
+    command = [get_ffmpeg_exe(), "-nostdin", "-loglevel", "error", "-i", input_file, "-f", "rawvideo", "-pix_fmt", "bgr24", "-"]
+    reader = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, bufsize=0)
+
+    try:
+        while True:
+            frame = np.empty((height, width, 3), dtype=np.uint8)
+            buffer = memoryview(frame).cast("B")
+            bytes_read = 0
+            while bytes_read < len(buffer):
+                chunk_size = reader.stdout.readinto(buffer[bytes_read:])
+                if not chunk_size:
+                    if reader.wait() != 0:
+                        raise subprocess.CalledProcessError(reader.returncode, command)
+                    return
+                bytes_read += chunk_size
+            yield frame
+    finally:
+        reader.terminate()
+        reader.stdout.close()
+        reader.wait()
+
+def open_video_writer(output_file, size, fps, audio_source=None):
+    command = [
+        get_ffmpeg_exe(), "-y", "-loglevel", "error",
+        "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{size[0]}x{size[1]}", "-r", f"{fps}", "-i", "-",
+    ]
+    if audio_source is not None:
+        command += ["-i", audio_source, "-map", "0:v", "-map", "1:a?", "-c:a", "aac"]
+    command += ["-c:v", "libx264"]
+    if size[0] % 2 == 0 and size[1] % 2 == 0:
+        command += ["-pix_fmt", "yuv420p"]
+    command.append(output_file)
+
+    return subprocess.Popen(command, stdin=subprocess.PIPE)
+
 def ensure_directory_exists(directory):
     if not os.path.exists(directory):
         try:
@@ -256,93 +499,267 @@ def ensure_directory_exists(directory):
         print(f"No write permission in directory {directory}: {e}")
         return False
 
+VIDEO_EXTENSIONS = {
+    ".3g2", ".3gp", ".asf", ".avi", ".divx", ".dv", ".f4v", ".flv", ".h264", ".hevc", ".m2t", ".m2ts",
+    ".m2v", ".m4v", ".mkv", ".mov", ".mp4", ".mpeg", ".mpg", ".mts", ".mxf", ".ogv", ".qt", ".rm",
+    ".rmvb", ".ts", ".vob", ".webm", ".wmv", ".y4m",
+}
+
 def is_valid_video_file(file):
-    try:
-        with VideoFileClip(file) as video_clip:
-            return True
-    except Exception as e:
-        print(f"Invalid video file: {file}, Error: {e}")
-        return False
+    return os.path.splitext(file)[1].lower() in VIDEO_EXTENSIONS
+
+BLEND_KERNEL_SIGNATURE = "void(uint8[:, :, :], uint8[:, :, :], uint16[:, :], uint8[:])"
+BLEND_TILE_SIZE = 64
+TILE_KEEP, TILE_COPY, TILE_BLEND = 0, 1, 2
+
+def classify_blend_tiles(mask, tile_size=BLEND_TILE_SIZE):
+    height, width = mask.shape
+    tiles_y = (height + tile_size - 1) // tile_size
+    tiles_x = (width + tile_size - 1) // tile_size
+
+    tile_kinds = np.full(tiles_y * tiles_x, TILE_BLEND, dtype=np.uint8)
+    for ty in range(tiles_y):
+        for tx in range(tiles_x):
+            tile = mask[ty * tile_size:(ty + 1) * tile_size, tx * tile_size:(tx + 1) * tile_size]
+            if not tile.any():
+                tile_kinds[ty * tiles_x + tx] = TILE_KEEP
+            elif (tile == 65535).all():
+                tile_kinds[ty * tiles_x + tx] = TILE_COPY
+
+    return tile_kinds
+
+@lru_cache(maxsize=None)
+def make_blend_kernel(height, width, tile_size=BLEND_TILE_SIZE):
+    tiles_y = (height + tile_size - 1) // tile_size
+    tiles_x = (width + tile_size - 1) // tile_size
+    source = f"""
+@njit(BLEND_KERNEL_SIGNATURE, parallel=True, boundscheck=False, fastmath=True)
+def blend(roi, processed_roi, mask, tile_kinds):
+    for tile in prange({tiles_y * tiles_x}):
+        kind = tile_kinds[tile]
+        y_start = (tile // {tiles_x}) * {tile_size}
+        x_start = (tile % {tiles_x}) * {tile_size}
+        y_end = min(y_start + {tile_size}, {height})
+        x_end = min(x_start + {tile_size}, {width})
+        if kind == {TILE_COPY}:
+            for y in range(y_start, y_end):
+                for x in range(x_start, x_end):
+                    roi[y, x, 0] = processed_roi[y, x, 0]
+                    roi[y, x, 1] = processed_roi[y, x, 1]
+                    roi[y, x, 2] = processed_roi[y, x, 2]
+        elif kind == {TILE_BLEND}:
+            for y in range(y_start, y_end):
+                for x in range(x_start, x_end):
+                    m = np.int64(mask[y, x])
+                    inv = 65535 - m
+                    roi[y, x, 0] = (m * processed_roi[y, x, 0] + inv * roi[y, x, 0] + 32768) >> 16
+                    roi[y, x, 1] = (m * processed_roi[y, x, 1] + inv * roi[y, x, 1] + 32768) >> 16
+                    roi[y, x, 2] = (m * processed_roi[y, x, 2] + inv * roi[y, x, 2] + 32768) >> 16
+"""
+    namespace = {"njit": njit, "prange": prange, "np": np, "BLEND_KERNEL_SIGNATURE": BLEND_KERNEL_SIGNATURE}
+    exec(source, namespace)
+    return namespace["blend"]
 
 class WatermarkProcessor:
-    def __init__(self, model, config, roi_coords, roi_mask):
+    def __init__(self, model, config, roi_coords, roi_mask, batch_size=8):
         self.model = model
         self.config = config
         self.roi_coords = roi_coords
         self.roi_mask = roi_mask
+        self.roi_mask_binary = (self.roi_mask > 0).astype(np.uint8) * 255
+        blurred_mask = cv2.GaussianBlur(self.roi_mask.astype(np.float32), (21, 21), 0)
+        self.blend_mask_u16 = np.clip(np.rint(blurred_mask * 257), 0, 65535).astype(np.uint16)
+        self.blend_tile_kinds = classify_blend_tiles(self.blend_mask_u16)
+        self.blend = make_blend_kernel(*self.blend_mask_u16.shape)
         self.frame_cache = FrameCache(cache_size=100, similarity_threshold=3)
-        self.skip_detector = FrameSkipDetector(keyframe_interval=5, scene_change_threshold=50.0)
+        self.skip_detector = FrameSkipDetector(keyframe_interval=5, scene_change_threshold=6.0)
         self.prev_processed_roi = None
+        self.last_roi_hash = None
+        self.cuda_graph = None
+        if torch.cuda.is_available() and getattr(getattr(model, "model", None), "name", None) == "lama":
+            self.cuda_graph = CudaGraphInpainter(model, self.roi_mask_binary, batch_size)
     
     def extract_roi(self, frame_bgr):
         y_min, y_max, x_min, x_max = self.roi_coords
         return frame_bgr[y_min:y_max, x_min:x_max]
     
+    def inpaint_rois(self, rois):
+        if self.cuda_graph is not None:
+            try:
+                return self.cuda_graph(rois)
+            except RuntimeError as e:
+                print(f"CUDA graph inpainting failed, falling back to eager mode: {e}")
+                self.cuda_graph = None
+        
+        return lama_inpaint_batch(rois, self.roi_mask_binary, self.model, self.config)
+    
     def process_frame(self, frame_bgr, frame_index):
-        y_min, y_max, x_min, x_max = self.roi_coords
-        roi = self.extract_roi(frame_bgr)
+        return self.process_batch([frame_bgr.copy()], frame_index)[0]
+    
+    def process_batch(self, frames_bgr, start_index):
+        rois = [self.extract_roi(frame_bgr) for frame_bgr in frames_bgr]
         
-        process_this_frame = self.skip_detector.should_process_frame(frame_index, roi)
+        sources = []
+        pending_rois = []
+        pending_keys = []
+        current_roi = self.prev_processed_roi
         
-        if process_this_frame:
-            processed_roi = self.frame_cache.get(roi)
+        for offset, roi in enumerate(rois):
+            roi_hash = xxhash.xxh3_64_intdigest(roi.tobytes())
+            if roi_hash == self.last_roi_hash and current_roi is not None:
+                sources.append(current_roi)
+                continue
             
-            if processed_roi is None:
-                processed_roi = lama_inpaint(roi, self.roi_mask, self.model, self.config)
-                processed_roi = cv2.cvtColor(processed_roi, cv2.COLOR_BGR2RGB)
-                self.frame_cache.put(roi, processed_roi)
+            if self.skip_detector.should_process_frame(start_index + offset, roi):
+                current_roi, cache_key = self.frame_cache.probe(roi)
+                
+                if current_roi is None:
+                    current_roi = len(pending_rois)
+                    pending_rois.append(roi)
+                    pending_keys.append(cache_key)
+                
+                self.skip_detector.update_prev_roi(roi)
+                self.last_roi_hash = roi_hash
+            else:
+                self.last_roi_hash = None
             
-            self.skip_detector.update_prev_roi(roi)
-            self.prev_processed_roi = processed_roi.copy()
-        else:
-            processed_roi = self.prev_processed_roi
+            sources.append(current_roi)
         
-        blend_mask = cv2.GaussianBlur(self.roi_mask.astype(np.float32), (21, 21), 0) / 255.0
+        inpainted_rois = self.inpaint_rois(pending_rois) if pending_rois else []
+        for cache_key, processed_roi in zip(pending_keys, inpainted_rois):
+            self.frame_cache.insert(cache_key, processed_roi)
         
-        result = frame_bgr.copy()
-        result[y_min:y_max, x_min:x_max] = (
-            blend_mask[:, :, np.newaxis] * processed_roi + 
-            (1 - blend_mask[:, :, np.newaxis]) * roi
-        )
+        processed_rois = [inpainted_rois[source] if isinstance(source, int) else source for source in sources]
+        self.prev_processed_roi = processed_rois[-1]
         
-        return result
+        for roi, processed_roi in zip(rois, processed_rois):
+            self.blend(roi, processed_roi, self.blend_mask_u16, self.blend_tile_kinds)
+        
+        return frames_bgr
+
 
+def run_frame_pipeline(frames, processor, output_stream, progress_bar, batch_size=8, queue_size=8):
+    frame_queue = queue.Queue(maxsize=queue_size)
+    result_queue = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    errors = []
 
-def process_video(video_clip, output_path, watermark_mask, model, config):
+    def drain(source_queue):
+        while source_queue.get() is not None:
+            pass
+
+    def read_frames():
+        try:
+            for frame_index, frame in enumerate(frames):
+                if stop_event.is_set():
+                    break
+                frame_queue.put((frame_index, frame))
+        except Exception as e:
+            errors.append(e)
+            stop_event.set()
+        finally:
+            frame_queue.put(None)
+
+    def process_frames():
+        finished = False
+        try:
+            while not finished:
+                if stop_event.is_set():
+                    break
+
+                batch = []
+                while len(batch) < batch_size:
+                    item = frame_queue.get()
+                    if item is None:
+                        finished = True
+                        break
+                    batch.append(item)
+
+                if batch:
+                    results = processor.process_batch([frame for _, frame in batch], batch[0][0])
+                    for (frame_index, _), result in zip(batch, results):
+                        result_queue.put((frame_index, result))
+        except Exception as e:
+            errors.append(e)
+            stop_event.set()
+        finally:
+            if not finished:
+                drain(frame_queue)
+            result_queue.put(None)
+
+    def write_frames():
+        pending_results = {}
+        next_index = 0
+        try:
+            while True:
+                item = result_queue.get()
+                if item is None:
+                    break
+                if stop_event.is_set():
+                    drain(result_queue)
+                    break
+
+                frame_index, result = item
+                pending_results[frame_index] = result
+                while next_index in pending_results:
+                    output_stream.write(pending_results.pop(next_index))
+                    next_index += 1
+                    progress_bar.update(1)
+        except Exception as e:
+            errors.append(e)
+            stop_event.set()
+            drain(result_queue)
+
+    threads = [
+        threading.Thread(target=read_frames, name="frame-reader", daemon=True),
+        threading.Thread(target=process_frames, name="frame-processor", daemon=True),
+        threading.Thread(target=write_frames, name="frame-writer", daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except BaseException:
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+        raise
+
+    if errors:
+        raise errors[0]
+
+def process_video(video_clip, output_path, watermark_mask, watermark_detector, model, config, batch_size=8):
     video_info = get_video_info(video_clip)
     start_time = time.time()
     
-    y_indices, x_indices = np.where(watermark_mask > 0)
-    if len(y_indices) == 0 or len(x_indices) == 0:
-        print("No watermark region found in mask")
-        return video_info
-        
-    margin = 50
-    y_min, y_max = max(0, np.min(y_indices) - margin), min(video_clip.h, np.max(y_indices) + margin)
-    x_min, x_max = max(0, np.min(x_indices) - margin), min(video_clip.w, np.max(x_indices) + margin)
+    roi_coords = watermark_detector.roi_coords
+    roi_mask = watermark_detector.extract_roi_mask(watermark_mask, roi_coords)
 
-    roi_coords = (y_min, y_max, x_min, x_max)
-    roi_mask = watermark_mask[y_min:y_max, x_min:x_max]
+    processor = WatermarkProcessor(model, config, roi_coords, roi_mask, batch_size=batch_size)
 
-    processor = WatermarkProcessor(model, config, roi_coords, roi_mask)
-
-    frame_count = 0
     total_frames = video_info["total_frames"]
     progress_bar = tqdm(total=total_frames, desc="Processing Frames", unit="frames")
     
-    def process_frame_wrapper(frame):
-        nonlocal frame_count
-        frame_bgr = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-        result = processor.process_frame(frame_bgr, frame_count)
-        
-        frame_count += 1
-        progress_bar.update(1)
-        return cv2.cvtColor(result, cv2.COLOR_BGR2RGB)
+    frames = iter_video_frames(video_clip.filename, video_clip.size)
+    writer = open_video_writer(f"{output_path}.mp4", video_clip.size, video_clip.fps, video_clip.filename)
     
-    processed_video = video_clip.image_transform(lambda frame: process_frame_wrapper(frame))
-    processed_video.write_videofile(f"{output_path}.mp4", codec="libx264", logger=None)
+    try:
+        run_frame_pipeline(frames, processor, writer.stdin, progress_bar, batch_size=batch_size)
+    finally:
+        try:
+            frames.close()
+        except ValueError:
+            pass
+        try:
+            writer.stdin.close()
+        except BrokenPipeError:
+            pass
+        writer.wait()
+        progress_bar.close()
     
-    progress_bar.close()
+    if writer.returncode != 0:
+        raise subprocess.CalledProcessError(writer.returncode, writer.args)
     
     end_time = time.time()
     processing_time = end_time - start_time
@@ -358,6 +775,7 @@ def parse_args():
     parser.add_argument("--input", "-i", type=str, default=".", help="Input directory containing videos")
     parser.add_argument("--output", "-o", type=str, default="output", help="Output directory")
     parser.add_argument("--preview", "-p", action="store_true", help="Preview effect before processing")
+    parser.add_argument("--optimize", action="store_true", help="Freeze and optimize the LaMa model for inference")
     return parser.parse_args()
 
 if __name__ == "__main__":
@@ -366,6 +784,7 @@ if __name__ == "__main__":
     input_dir = args.input
     output_dir = args.output
     preview_enabled = args.preview
+    optimize_enabled = args.optimize
     
     if not ensure_directory_exists(output_dir):
         sys.exit(1)
@@ -387,10 +806,24 @@ if __name__ == "__main__":
     
     for video in videos:
         print(f"Processing {video}")
-        video_clip = VideoFileClip(video)
+        try:
+            video_clip = VideoFileClip(video)
+        except Exception as e:
+            print(f"Invalid video file: {video}, Error: {e}")
+            continue
 
         if watermark_mask is None:
             watermark_mask = watermark_detector.generate_mask(video_clip)
+            
+            try:
+                watermark_detector.get_roi_coordinates(watermark_mask)
+            except ValueError as e:
+                print(e)
+                sys.exit(1)
+
+            if optimize_enabled:
+                sample_frame = watermark_detector.get_first_valid_frame(video_clip)
+                optimize_lama(lama_model, sample_frame, watermark_mask)
 
         if preview_enabled:
             if not watermark_detector.preview_effect(video_clip, watermark_mask, lama_model, lama_config):
@@ -400,7 +833,7 @@ if __name__ == "__main__":
         video_name = os.path.basename(video)
         output_video_path = os.path.join(output_dir, os.path.splitext(video_name)[0])
 
-        processing_info = process_video(video_clip, output_video_path, watermark_mask, lama_model, lama_config)
+        processing_info = process_video(video_clip, output_video_path, watermark_mask, watermark_detector, lama_model, lama_config)
         
         print(f"Successfully processed {video_name}")
         print(f"  分辨率: {processing_info['video_info']['resolution']}")